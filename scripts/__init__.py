@@ -1,7 +1,8 @@
-from .formats import to_json, validate
+from .formats import ValidationError, to_json, validate, validate_stream, write_json
 from .parse import Token, Tokens, OsVersion, OsVersions, Translation
 from .tokenide import TokenIDESheet
 from .trie import TokenTrie
 
 __all__ = ["Token", "Tokens", "OsVersion", "OsVersions", "Translation",
-           "TokenTrie", "TokenIDESheet", "to_json", "validate"]
+           "TokenTrie", "TokenIDESheet", "ValidationError", "to_json", "validate", "validate_stream",
+           "write_json"]
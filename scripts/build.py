@@ -1,22 +1,49 @@
-import json
-import xml.etree.ElementTree as ET
+import shutil
+
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import orjson
+
+except ImportError:
+    orjson = None
 
 from . import *
+from .parse import ET, xml_parser
+
+
+MODELS = "TI-82", "TI-83", "TI-83+", "TI-84+", "TI-84+CSE", "TI-84+CE"
+
+
+def build_8x():
+    root = ET.parse("8X.xml", xml_parser()).getroot()
+    validate(root)
+
+    shutil.copyfile("8X.xml", "built/8X.xml")
+
+    if orjson is not None:
+        with open("built/8X.json", "wb+") as outfile:
+            outfile.write(orjson.dumps(to_json(root), option=orjson.OPT_INDENT_2))
+
+    else:
+        with open("built/8X.json", "w+", encoding="UTF-8") as outfile:
+            write_json(root, outfile)
 
 
-with open("8X.xml", encoding="UTF-8") as infile:
-    root = ET.fromstring(src := infile.read())
+def build_tokenide(sheet: TokenIDESheet, model: str):
+    with open(f"built/tokenide/{model}.xml", "w+", encoding="UTF-8") as outfile:
+        outfile.write(sheet.for_version(version=OsVersion(model, "latest")).to_xml_string())
 
-    with open("built/8X.xml", "w+", encoding="UTF-8") as outfile:
-        validate(root)
-        outfile.write(src)
 
-    with open("built/8X.json", "w+", encoding="UTF-8") as outfile:
-        json.dump(to_json(root), outfile, indent=2, ensure_ascii=False)
+if __name__ == "__main__":
+    with open(".github/workflows/tokenide.xml", "rb") as infile:
+        sheet = TokenIDESheet.from_file(infile)
 
-with open(".github/workflows/tokenide.xml", encoding="UTF-8") as infile:
-    sheet = TokenIDESheet.from_xml_string(infile.read())
+    # Each output is independent, so build them all in parallel
+    with ProcessPoolExecutor() as executor:
+        futures = [executor.submit(build_8x),
+                   *(executor.submit(build_tokenide, sheet, model) for model in MODELS)]
 
-    for model in "TI-82", "TI-83", "TI-83+", "TI-84+", "TI-84+CSE", "TI-84+CE":
-        with open(f"built/tokenide/{model}.xml", "w+", encoding="UTF-8") as outfile:
-            outfile.write(sheet.for_version(version=OsVersion(model, "latest")).to_xml_string())
+        # Re-raise any failure, e.g. an invalid sheet
+        for future in futures:
+            future.result()
@@ -2,11 +2,264 @@ import json
 import re
 import xml.etree.ElementTree as ET
 
-from collections import defaultdict
+from collections import defaultdict, deque
+from json.encoder import encode_basestring
+from typing import TextIO
 
 from .parse import OsVersion, OsVersions
 
 
+# Patterns used to validate the sheet, compiled once rather than per element
+_RE_BYTE = re.compile(r"\$[0-9A-F]{2}", flags=re.DOTALL)
+_RE_TI_ASCII = re.compile(r"([0-9A-F]{2})+", flags=re.DOTALL)
+_RE_LANG_CODE = re.compile(r"[a-z]{2}", flags=re.DOTALL)
+_RE_DISPLAY = re.compile(r".+", flags=re.DOTALL)
+_RE_ACCESSIBLE = re.compile(r"[\u0000-\u00FF]+", flags=re.DOTALL)
+_RE_VARIANT = re.compile(r".+", flags=re.DOTALL)
+_RE_MODEL = re.compile(r"TI-\d\d.*", flags=re.DOTALL)
+_RE_OSVER = re.compile(r"(\d+\.)+\d+", flags=re.DOTALL)
+
+# Patterns for the sequence of child tags of each element
+_RE_TOKENS_CHILDREN = re.compile(r"(<token>|<two-byte>)+")
+_RE_TWO_BYTE_CHILDREN = re.compile(r"(<token>)+")
+_RE_TOKEN_CHILDREN = re.compile(r"(<version>)+")
+_RE_VERSION_CHILDREN = re.compile(r"<since>(<until>)?(<lang>)+")
+_RE_OS_VERSION_CHILDREN = re.compile(r"<model><os-version>")
+_RE_LANG_CHILDREN = re.compile(r"<accessible>(<variant>)*")
+
+
+# Equivalent checks for the simplest patterns, which avoid the regex engine entirely
+_HEX_DIGITS = "0123456789ABCDEF"
+
+
+def _is_byte(string: str) -> bool:
+    return len(string) == 3 and string[0] == "$" and string[1] in _HEX_DIGITS and string[2] in _HEX_DIGITS
+
+
+def _is_hex_pairs(string: str) -> bool:
+    return bool(string) and not len(string) % 2 and not string.strip(_HEX_DIGITS)
+
+
+def _is_lang_code(string: str) -> bool:
+    return len(string) == 2 and string.isascii() and string.isalpha() and string.islower()
+
+
+def _is_latin1(string: str) -> bool:
+    return bool(string) and max(string) <= "\u00FF"
+
+
+# Predicates by attribute name and by tag, each equivalent to the pattern that name is checked against
+_ATTRIBUTE_PREDICATES = {
+    "value": _is_byte,
+    "ti-ascii": _is_hex_pairs,
+    "code": _is_lang_code
+}
+
+_TEXT_PREDICATES = {
+    "accessible": _is_latin1
+}
+
+# Tags whose child pattern only requires one or more children from a set of tags, in any order
+_CHILD_TAGS = {
+    "tokens": frozenset({"token", "two-byte"}),
+    "two-byte": frozenset({"token"}),
+    "token": frozenset({"version"})
+}
+
+
+class ValidationError(ValueError):
+    """
+    Error raised when a token sheet is found to be invalid
+    """
+
+    def __init__(self, byte: str, message: str):
+        super().__init__((f"token 0x{byte}: " if byte else "root: ") + message)
+
+        self.byte = byte
+        self.message = message
+
+    def __reduce__(self):
+        return ValidationError, (self.byte, self.message)
+
+
+class _SheetState:
+    """
+    Data class for the running state of a sheet validation
+    """
+
+    def __init__(self):
+        self.all_tokens = set()
+        self.all_names = {}
+        self.version = None
+
+        # The names seen so far in the current version, by language, and for the current language
+        self.names = None
+        self.lang_names = None
+
+
+# Require attributes matching regexes
+def _attributes(element: ET.Element, byte: str, attrs: dict[str, re.Pattern]):
+    attrib = element.attrib
+
+    for attr, pattern in attrs.items():
+        if (value := attrib.get(attr)) is None:
+            raise ValidationError(byte, f"<{element.tag}> does not have attribute {attr}")
+
+        if not _ATTRIBUTE_PREDICATES.get(attr, pattern.fullmatch)(value):
+            raise ValidationError(byte, f"<{element.tag}> {attr} '{value}' does not match r'{pattern.pattern}'")
+
+    if len(attrib) > len(attrs):
+        extra = next(attr for attr in attrib if attr not in attrs)
+        raise ValidationError(byte, f"<{element.tag}> has unexpected attribute {extra}")
+
+
+# Require child tags to match regex when appended in order
+def _children(element: ET.Element, byte: str, pattern: re.Pattern):
+    _child_tags(element.tag, [child.tag for child in element], byte, pattern)
+
+
+def _child_tags(tag: str, child_tags: list[str], byte: str, pattern: re.Pattern):
+    if (tags := _CHILD_TAGS.get(tag)) is not None:
+        if child_tags and all(child_tag in tags for child_tag in child_tags):
+            return
+
+    elif pattern.fullmatch("".join(f"<{child_tag}>" for child_tag in child_tags)):
+        return
+
+    raise ValidationError(byte, f"children of <{tag}> do not match r'{pattern.pattern}'")
+
+
+# Require text to match regex
+def _text(element: ET.Element, byte: str, pattern: re.Pattern):
+    # Every text pattern requires at least one character, so empty elements fail without a match
+    if not (text := element.text or "") or not _TEXT_PREDICATES.get(element.tag, pattern.fullmatch)(text):
+        raise ValidationError(byte, f"<{element.tag}> text '{text}' does not match r'{pattern.pattern}'")
+
+
+# Check requirements for each tag
+def _validate_tokens(element: ET.Element, byte: str, lang: str, state: _SheetState):
+    _children(element, byte, _RE_TOKENS_CHILDREN)
+
+
+def _validate_two_byte(element: ET.Element, byte: str, lang: str, state: _SheetState):
+    _attributes(element, byte, {"value": _RE_BYTE})
+    _children(element, byte, _RE_TWO_BYTE_CHILDREN)
+
+
+def _validate_token(element: ET.Element, byte: str, lang: str, state: _SheetState):
+    _attributes(element, byte, {"value": _RE_BYTE})
+    _children(element, byte, _RE_TOKEN_CHILDREN)
+
+    if byte in state.all_tokens:
+        raise ValidationError(byte, "token byte must be unique")
+
+    state.all_tokens.add(byte)
+
+
+def _validate_version(element: ET.Element, byte: str, lang: str, state: _SheetState):
+    state.version = OsVersions.INITIAL
+    _children(element, byte, _RE_VERSION_CHILDREN)
+
+
+def _validate_since(element: ET.Element, byte: str, lang: str, state: _SheetState):
+    try:
+        this_version = OsVersion.from_element(element)
+
+    except ValueError as error:
+        # Report malformed children with their own messages before the version is compared
+        _children(element, byte, _RE_OS_VERSION_CHILDREN)
+        for child in element:
+            _VALIDATE_HANDLERS[child.tag](child, byte, lang, state)
+
+        raise ValidationError(byte, str(error)) from error
+
+    if this_version < state.version:
+        raise ValidationError(byte, f"version {this_version} overlaps with {state.version}")
+
+    state.version = this_version
+
+    # Workaround for nested defaultdict
+    if this_version not in state.all_names:
+        state.all_names[this_version] = defaultdict(set)
+
+    state.names = state.all_names[this_version]
+
+    _children(element, byte, _RE_OS_VERSION_CHILDREN)
+
+
+def _validate_until(element: ET.Element, byte: str, lang: str, state: _SheetState):
+    _children(element, byte, _RE_OS_VERSION_CHILDREN)
+
+
+def _validate_lang(element: ET.Element, byte: str, lang: str, state: _SheetState):
+    _attributes(element, byte, {"code": _RE_LANG_CODE, "ti-ascii": _RE_TI_ASCII, "display": _RE_DISPLAY})
+    _children(element, byte, _RE_LANG_CHILDREN)
+
+    state.lang_names = state.names[lang]
+
+
+# Require a name to be unique within its version and language
+def _unique_name(element: ET.Element, byte: str, lang: str, state: _SheetState, kind: str):
+    if element.text in state.lang_names:
+        raise ValidationError(byte, f"{lang} {kind} name '{element.text}' is not unique within {state.version}")
+
+    state.lang_names.add(element.text)
+
+
+def _validate_accessible(element: ET.Element, byte: str, lang: str, state: _SheetState):
+    _text(element, byte, _RE_ACCESSIBLE)
+
+    _unique_name(element, byte, lang, state, "accessible")
+
+
+def _validate_variant(element: ET.Element, byte: str, lang: str, state: _SheetState):
+    _text(element, byte, _RE_VARIANT)
+
+    _unique_name(element, byte, lang, state, "variant")
+
+
+def _validate_model(element: ET.Element, byte: str, lang: str, state: _SheetState):
+    _text(element, byte, _RE_MODEL)
+
+
+def _validate_os_version(element: ET.Element, byte: str, lang: str, state: _SheetState):
+    _text(element, byte, _RE_OSVER)
+
+
+_VALIDATE_HANDLERS = {
+    "tokens": _validate_tokens,
+    "two-byte": _validate_two_byte,
+    "token": _validate_token,
+    "version": _validate_version,
+    "since": _validate_since,
+    "until": _validate_until,
+    "lang": _validate_lang,
+    "accessible": _validate_accessible,
+    "variant": _validate_variant,
+    "model": _validate_model,
+    "os-version": _validate_os_version
+}
+
+
+# Walk an element and its descendants in document order, carrying each element's byte and language code
+def _walk(element: ET.Element, byte: str, lang: str, state: _SheetState):
+    stack = deque([(element, byte, lang)])
+    while stack:
+        element, byte, lang = stack.pop()
+        attrib = element.attrib
+
+        byte += attrib.get("value", "").lstrip("$")
+        lang += attrib.get("code", "")
+
+        if (handler := _VALIDATE_HANDLERS.get(tag := element.tag)) is None:
+            raise ValidationError(byte, f"unrecognized tag <{tag}>")
+
+        handler(element, byte, lang, state)
+
+        # Visit children
+        stack.extend((child, byte, lang) for child in reversed(element))
+
+
 def validate(root: ET.Element) -> int:
     """
     Validates a token sheet, raising an error if an invalid component is found
@@ -18,118 +271,135 @@ def validate(root: ET.Element) -> int:
     if root.tag != "tokens":
         raise ValueError("not a token sheet")
 
-    all_tokens = set()
-    all_names = {}
+    state = _SheetState()
+    _walk(root, "", "", state)
+
+    return len(state.all_tokens)
+
+
+def validate_stream(source) -> int:
+    """
+    Validates a token sheet while it is parsed, raising an error if an invalid component is found
 
-    version = None
+    Each token is validated as soon as it has been read and is then discarded,
+    so only one token of the sheet is held in memory at a time.
 
-    def visit(element: ET.Element, byte: str = "", lang: str = ""):
-        nonlocal version
+    :param source: A filename or file object containing the sheet
+    :return: The number of tokens in the sheet
+    """
 
-        byte += element.attrib.get("value", "").lstrip("$")
-        lang += element.attrib.get("code", "")
+    state = _SheetState()
 
-        class ValidationError(ValueError):
-            __qualname__ = "ValidationError"
+    # Tags of the currently open elements, and the byte of the open <two-byte>, if any
+    tags = []
+    page = ""
 
-            def __init__(self, message: str):
-                super().__init__((f"token 0x{byte}: " if byte else "root: ") + message)
+    # The open <tokens> and <two-byte> elements, with the tags of the children each has closed
+    parents = []
+    children = []
 
-        # Require attributes matching regexes
-        def attributes(attrs: dict[str, str]):
-            attrib = element.attrib.copy()
+    for event, element in ET.iterparse(source, events=("start", "end")):
+        if event == "start":
+            if not tags:
+                if element.tag != "tokens":
+                    raise ValueError("not a token sheet")
 
-            for attr, regex in attrs.items():
-                if attr not in attrib:
-                    raise ValidationError(f"<{element.tag}> does not have attribute {attr}")
+                parents.append(element)
+                children.append([])
 
-                if not re.fullmatch(regex, value := attrib.pop(attr), flags=re.DOTALL):
-                    raise ValidationError(f"<{element.tag}> {attr} '{value}' does not match r'{regex}'")
+            # Check a page's byte before any of its tokens
+            elif tags == ["tokens"] and element.tag == "two-byte":
+                page = element.attrib.get("value", "").lstrip("$")
+                _attributes(element, page, {"value": _RE_BYTE})
 
-            if attrib:
-                raise ValidationError(f"<{element.tag}> has unexpected attribute {[*attrib.values()][0]}")
+                parents.append(element)
+                children.append([])
 
-        # Require child tags to match regex when appended in order
-        def children(regex: str):
-            if not re.fullmatch(regex, "".join(f"<{child.tag}>" for child in element)):
-                raise ValidationError(f"children of <{element.tag}> do not match r'{regex}'")
+            tags.append(element.tag)
+            continue
 
-        # Require text to match regex
-        def text(regex: str):
-            if not re.fullmatch(regex, element.text, flags=re.DOTALL):
-                raise ValidationError(f"<{element.tag}> text '{element.text}' does not match r'{regex}'")
+        tags.pop()
 
-        # Check requirements for each tag
-        match element.tag:
-            case "tokens":
-                children(r"(<token>|<two-byte>)+")
+        match tags, element.tag:
+            case ["tokens"], "token":
+                _walk(element, "", "", state)
 
-            case "two-byte":
-                attributes({"value": r"\$[0-9A-F]{2}"})
-                children(r"(<token>)+")
+            case ["tokens", "two-byte"], "token":
+                _walk(element, page, "", state)
 
-            case "token":
-                attributes({"value": r"\$[0-9A-F]{2}"})
-                children(r"(<version>)+")
+            # Containers are checked once all their children are read
+            case ["tokens"], "two-byte":
+                parents.pop()
+                _child_tags(element.tag, children.pop(), page, _RE_TWO_BYTE_CHILDREN)
+                page = ""
 
-                if byte in all_tokens:
-                    raise ValidationError("token byte must be unique")
+            case [], "tokens":
+                _child_tags(element.tag, children.pop(), "", _RE_TOKENS_CHILDREN)
 
-                all_tokens.add(byte)
+        # Children of a container are read in full once closed, so they are removed to free them
+        if len(tags) == len(parents) and tags:
+            children[-1].append(element.tag)
+            del parents[-1][-1]
 
-            case "version":
-                version = OsVersions.INITIAL
-                children(r"<since>(<until>)?(<lang>)+")
+    return len(state.all_tokens)
 
-            case "since":
-                if (this_version := OsVersion.from_element(element)) < version:
-                    raise ValidationError(f"version {this_version} overlaps with {version}")
 
-                version = this_version
-                
-                # Workaround for nested defaultdict
-                all_names[version] = all_names.get(version, defaultdict(set))
+# Combine the JSON values of an element's children into its own
+def _json_tokens(element: ET.Element, values: list) -> dict:
+    return {child.attrib["value"]: value for child, value in zip(element, values)}
 
-                children(r"<model><os-version>")
 
-            case "until":
-                children(r"<model><os-version>")
+def _json_token(element: ET.Element, values: list) -> list:
+    return values
 
-            case "lang":
-                attributes({"code": r"[a-z]{2}", "ti-ascii": r"([0-9A-F]{2})+", "display": r".+"})
-                children(r"<accessible>(<variant>)*")
 
-            case "accessible":
-                text(r"[\u0000-\u00FF]+")
+def _json_version(element: ET.Element, values: list) -> dict:
+    dct = {}
+    langs = {}
 
-                if element.text in all_names[version][lang]:
-                    raise ValidationError(f"{lang} accessible name '{element.text}' is not unique within {version}")
+    for child, value in zip(element, values):
+        if (tag := child.tag) == "lang":
+            langs[child.attrib["code"]] = value
 
-                all_names[version][lang].add(element.text)
+        else:
+            dct[tag] = value
 
-            case "variant":
-                text(r".+")
+    dct["langs"] = langs
+    return dct
 
-                if element.text in all_names[version][lang]:
-                    raise ValidationError(f"{lang} variant name '{element.text}' is not unique within {version}")
 
-                all_names[version][lang].add(element.text)
+def _json_lang(element: ET.Element, values: list) -> dict:
+    attrib = element.attrib
+    dct = {"ti-ascii": attrib["ti-ascii"], "display": attrib["display"]}
+    variants = []
 
-            case "model":
-                text(r"TI-\d\d.*")
+    for child in element:
+        if (tag := child.tag) == "variant":
+            variants.append(child.text)
 
-            case "os-version":
-                text(r"(\d+\.)+\d+")
+        else:
+            dct[tag] = child.text
 
-            case _:
-                raise ValidationError(f"unrecognized tag <{element.tag}>")
+    if variants:
+        dct["variants"] = variants
 
-        # Visit children
-        for child in element:
-            visit(child, byte, lang)
+    return dct
+
+
+def _json_default(element: ET.Element, values: list):
+    if values:
+        return {child.tag: value for child, value in zip(element, values)}
+    else:
+        return element.text
 
-    visit(root)
-    return len(all_tokens)
+
+_JSON_HANDLERS = {
+    "tokens": _json_tokens,
+    "two-byte": _json_tokens,
+    "token": _json_token,
+    "version": _json_version,
+    "lang": _json_lang
+}
 
 
 def to_json(element: ET.Element):
@@ -140,52 +410,70 @@ def to_json(element: ET.Element):
     :return: The element and all its descendants as JSON
     """
 
-    match element.tag:
-        case "tokens" | "two-byte":
-            return {child.attrib["value"]: to_json(child) for child in element}
+    # Each element is visited twice: once to queue its children, then once to combine their results
+    stack = deque([(element, False)])
+    results = []
 
-        case "token":
-            return [to_json(child) for child in element]
+    while stack:
+        element, visited = stack.pop()
 
-        case "version":
-            dct = {}
-            langs = {}
+        tag = element.tag
 
-            for child in element:
-                if child.tag == "lang":
-                    langs[child.attrib["code"]] = to_json(child)
+        if not visited:
+            stack.append((element, True))
 
-                else:
-                    dct[child.tag] = to_json(child)
+            # <lang> reads its children directly
+            if tag != "lang":
+                stack.extend((child, False) for child in reversed(element))
 
-            return dct | {"langs": langs}
+            continue
 
-        case "lang":
-            dct = {"ti-ascii": element.attrib["ti-ascii"], "display": element.attrib["display"]}
-            variants = []
+        if tag == "lang" or not (count := len(element)):
+            values = []
 
-            for child in element:
-                if child.tag == "variant":
-                    variants.append(child.text)
+        else:
+            values = results[-count:]
+            del results[-count:]
 
-                else:
-                    dct[child.tag] = child.text
+        results.append(_JSON_HANDLERS.get(tag, _json_default)(element, values))
 
-            if variants:
-                return dct | {"variants": variants}
+    return results.pop()
 
-            else:
-                return dct
 
-        case _:
-            if list(element):
-                return {child.tag: to_json(child) for child in element}
-            else:
-                return element.text
+def write_json(element: ET.Element, out: TextIO, indent: int = 0):
+    """
+    Writes the JSON representation of a token sheet to a file
+
+    The output is identical to dumping to_json(element) with an indent of 2,
+    but the pages and tokens are streamed out so the full JSON object is never built.
+
+    :param element: An XML element; call on the root element to write the entire sheet
+    :param out: A text file to write to
+    :param indent: The indentation of the element in the output
+    """
 
+    match element.tag:
+        case "tokens" | "two-byte" | "token":
+            opening, closing = ("[", "]") if element.tag == "token" else ("{", "}")
+            out.write(opening)
+
+            for index, child in enumerate(element):
+                out.write(",\n" if index else "\n")
+                out.write(" " * (indent + 2))
+
+                if element.tag != "token":
+                    out.write(f"{encode_basestring(child.attrib['value'])}: ")
+
+                write_json(child, out, indent + 2)
 
-# with open("../8X.xml", encoding="UTF-8") as file:
-#   json.dumps(to_json(ET.fromstring(file.read())), indent=2)
+            if len(element):
+                out.write("\n" + " " * indent)
+
+            out.write(closing)
+
+        case _:
+            # Individual versions are small enough to build whole
+            out.write(json.dumps(to_json(element), indent=2, ensure_ascii=False).replace("\n", "\n" + " " * indent))
 
 
-__all__ = ["to_json", "validate"]
+__all__ = ["ValidationError", "to_json", "validate", "validate_stream", "write_json"]
@@ -1,9 +1,45 @@
 import functools
-import xml.etree.ElementTree as ET
-from dataclasses import dataclass
+import hashlib
+import sys
+from dataclasses import dataclass, field
+from typing import BinaryIO, Final
+
+try:
+    from lxml import etree as ET
+    _PARSER_OPTIONS = {"remove_comments": True}
+
+except ImportError:
+    import xml.etree.ElementTree as ET
+    _PARSER_OPTIONS = {}
+
+
+def xml_parser(**options) -> 'ET.XMLParser':
+    """
+    Constructs a parser for the token sheets with whichever ElementTree implementation is in use
+
+    lxml is used if it is installed, in which case comments are removed just as ElementTree does by default.
+
+    :param options: Further parser options
+    :return: An XML parser
+    """
+
+    return ET.XMLParser(**options, **_PARSER_OPTIONS)
+
+
+def xml_iterparse(file: BinaryIO, events: tuple[str, ...]):
+    """
+    Incrementally parses a file with whichever ElementTree implementation is in use
+
+    :param file: An XML file opened in binary mode
+    :param events: The events to report
+    :return: An iterator of event and element pairs
+    """
+
+    return ET.iterparse(file, events=events, **_PARSER_OPTIONS)
+
 
 # Models ordered such that models earlier in the list are earlier in the evolution of the token tables
-MODEL_ORDER = {
+MODEL_ORDER: Final[dict[str, int]] = {
     "": 0,
 
     "TI-82": 10,
@@ -41,8 +77,7 @@ MODEL_ORDER = {
 }
 
 
-@functools.total_ordering
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class OsVersion:
     """
     Data class for defining and comparing OS versions
@@ -58,28 +93,37 @@ class OsVersion:
     model: str
     version: str
 
-    def __lt__(self, other):
-        order1 = MODEL_ORDER[self.model]
-        order2 = MODEL_ORDER[other.model]
-
-        if order1 < order2:
-            return True
-        elif order1 > order2:
-            return False
-        else:
-            if self.version == "latest":
-                return False
-            elif other.version == "latest":
-                return True
-            elif other.version == "":
-                return False
-            elif self.version == "":
-                return True
-            else:
-                return self.version.split(".") < other.version.split(".")
+    # Parsed once on construction so that comparisons are plain tuple comparisons
+    _key: tuple[int, tuple[int, ...]] = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        match self.version:
+            case "":
+                parts = (-1,)
+            case "latest":
+                parts = (sys.maxsize,)
+            case _:
+                parts = tuple(map(int, self.version.split(".")))
+
+        object.__setattr__(self, "_key", (MODEL_ORDER[self.model], parts))
+
+    def __lt__(self, other: 'OsVersion') -> bool:
+        return self._key < other._key
+
+    def __le__(self, other: 'OsVersion') -> bool:
+        return self._key <= other._key
+
+    def __gt__(self, other: 'OsVersion') -> bool:
+        return self._key > other._key
+
+    def __ge__(self, other: 'OsVersion') -> bool:
+        return self._key >= other._key
 
     def __eq__(self, other):
-        return MODEL_ORDER[self.model] == MODEL_ORDER[other.model] and self.version == other.version
+        return self._key == other._key
+
+    def __hash__(self):
+        return hash(self._key)
 
     @staticmethod
     def from_element(element: ET.Element) -> 'OsVersion':
@@ -95,9 +139,9 @@ class OsVersion:
 
         for child in element:
             if child.tag == "model":
-                model = child.text
+                model = child.text or ""
             elif child.tag == "os-version":
-                version = child.text
+                version = child.text or ""
             else:
                 raise ValueError("Unrecognized tag in " + element.tag + ": " + child.tag)
 
@@ -106,14 +150,28 @@ class OsVersion:
         elif model == "":
             raise ValueError("<" + element.tag + "> has a missing or empty <model> tag.")
 
-        if model not in MODEL_ORDER or model == "latest":  # "latest" is for user convenience, not the sheet itself
-            raise ValueError("Unrecognized <model>: " + model)
+        return _os_version(sys.intern(model), version)
+
+
+@functools.lru_cache(maxsize=256)
+def _os_version(model: str, version: str) -> OsVersion:
+    # Sheets repeat the same handful of versions for every token, so each is only checked and built once
+    if model not in MODEL_ORDER or model == "latest":  # "latest" is for user convenience, not the sheet itself
+        raise ValueError("Unrecognized <model>: " + model)
+
+    if not all(part.isdecimal() for part in version.split(".")):
+        raise ValueError(
+            "Invalid <version> string \"" + version + "\", must be a sequence of numbers separated by periods.")
+
+    return OsVersion(model, version)
+
+
+# Decoded bytes for every value attribute in canonical form, e.g. "$BB" -> b"\xBB"
+_BYTE_VALUES: Final[dict[str, bytes]] = {f"${byte:02X}": bytes([byte]) for byte in range(256)}
 
-        if any([c != '.' and not c.isnumeric() for c in version]):
-            raise ValueError(
-                "Invalid <version> string \"" + version + "\", must be a sequence of numbers separated by periods.")
 
-        return OsVersion(model, version)
+def _decode_byte(value: str) -> bytes:
+    return _BYTE_VALUES.get(value) or bytes.fromhex(value[1:])
 
 
 class OsVersions:
@@ -123,8 +181,8 @@ class OsVersions:
     This class can be extended with useful versions for other applications.
     """
     
-    INITIAL = OsVersion("", "")
-    LATEST = OsVersion("latest", "latest")
+    INITIAL: Final = OsVersion("", "")
+    LATEST: Final = OsVersion("latest", "latest")
 
 
 class Translation:
@@ -137,22 +195,26 @@ class Translation:
         - The accessible name, an ASCII string intended to be easy to type
         - Any variant names; such may be derived from their use in other tokenization tools
     """
-    
+
+    __slots__ = ("ti_ascii", "display", "accessible", "variants", "_names")
+
     def __init__(self, ti_ascii: bytes, display: str, accessible: str, variants: list[str]):
         self.ti_ascii = ti_ascii
         self.display = display
         self.accessible = accessible
         self.variants = variants
 
-    def names(self) -> list[str]:
+        self._names = (accessible, *variants)
+
+    def names(self) -> tuple[str, ...]:
         """
-        :return: A list of all names in this translation used for tokenization
+        :return: A tuple of all names in this translation used for tokenization
         """
         
-        return [self.accessible, *self.variants]
+        return self._names
 
     @staticmethod
-    def from_element(element: ET.Element) -> (str, 'Translation'):
+    def from_element(element: ET.Element) -> tuple[str, 'Translation']:
         """
         Constructs an instance and its key from an XML element in a token sheet
 
@@ -160,7 +222,8 @@ class Translation:
         :return: A tuple of a string key and a token translation corresponding to the element
         """
         
-        code = element.attrib["code"]
+        # There are only a few language codes, shared by every token
+        code = sys.intern(element.attrib["code"])
 
         ti_ascii = bytes.fromhex(element.attrib["ti-ascii"])
         display = element.attrib["display"]
@@ -169,11 +232,10 @@ class Translation:
         variants = []
 
         for child in element:
-            match child.tag:
-                case "accessible":
-                    accessible = child.text
-                case "variant":
-                    variants.append(child.text)
+            if (tag := child.tag) == "variant":
+                variants.append(child.text)
+            elif tag == "accessible":
+                accessible = child.text
 
         return code, Translation(ti_ascii, display, accessible, variants)
 
@@ -189,8 +251,10 @@ class Token:
         - The latest OS version supporting this token
         - Any additional attributes stored in the token sheets
     """
-    
-    def __init__(self, bits: bytes, langs: dict[str, Translation], attrs: dict[str, str] = None,
+
+    __slots__ = ("bits", "langs", "attrs", "since", "until")
+
+    def __init__(self, bits: bytes, langs: dict[str, Translation], attrs: dict[str, str] | None = None,
                  since: OsVersion = OsVersions.INITIAL,
                  until: OsVersion = OsVersions.LATEST):
         self.bits = bits
@@ -200,7 +264,7 @@ class Token:
         self.until = until
 
     @staticmethod
-    def from_element(element: ET.Element, bits: bytes, version: OsVersion = OsVersions.LATEST):
+    def from_element(element: ET.Element, bits: bytes, version: OsVersion = OsVersions.LATEST) -> 'Token':
         """
         Constructs an instance from an XML element in the token sheets
 
@@ -217,27 +281,32 @@ class Token:
             below, above = False, True
 
             for child in version_elem:
-                match child.tag:
-                    case "since":
-                        version_since = OsVersion.from_element(child)
-                        if version_since < version:
-                            below = True
-                            since = version_since
+                # <lang> is the most common child, so it is checked first
+                if (tag := child.tag) == "lang":
+                    if above and below:
+                        code, translation = Translation.from_element(child)
+                        langs[code] = translation
+
+                elif tag == "since":
+                    version_since = OsVersion.from_element(child)
+                    if version_since < version:
+                        below = True
+                        since = version_since
 
-                    case "until":
-                        version_until = OsVersion.from_element(child)
-                        if version_until < version:
-                            above = False
+                    else:
+                        # This also skips the version's <until>, but only a token's first version has one in the
+                        # sheets; if that version is skipped, so are the later ones, and the token has no translations
+                        break
 
-                        else:
-                            until = version_until
+                elif tag == "until":
+                    version_until = OsVersion.from_element(child)
+                    if version_until < version:
+                        above = False
 
-                    case "lang":
-                        if above and below:
-                            code, translation = Translation.from_element(child)
-                            langs[code] = translation
+                    else:
+                        until = version_until
 
-        return Token(bits, langs, attrs=element.attrib, since=since, until=until)
+        return Token(bits, langs, attrs=dict(element.attrib), since=since, until=until)
 
 
 class Tokens:
@@ -255,19 +324,52 @@ class Tokens:
         self.langs = lang_map
 
     @staticmethod
-    def from_xml_string(xml_str: str, version: OsVersion = OsVersions.LATEST):
+    def from_xml_string(xml_str: str, version: OsVersion = OsVersions.LATEST) -> 'Tokens':
         """
         Constructs an instance from an XML string
 
+        Results are cached by the string's digest and the version, so repeated calls share one instance.
+        Callers should not modify the returned maps.
+
         :param xml_str: An XML string
         :param version: A minimum OS version (defaults to latest)
         :return: Token maps corresponding to the string
         """
-        
-        return Tokens.from_element(ET.fromstring(xml_str), version=version)
+
+        # lxml rejects strings with an encoding declaration, so parse the encoded bytes instead
+        data = xml_str.encode("UTF-8")
+        key = hashlib.blake2b(data, digest_size=16).digest(), version
+
+        if key not in _TOKENS_CACHE:
+            if len(_TOKENS_CACHE) >= _TOKENS_CACHE_SIZE:
+                del _TOKENS_CACHE[next(iter(_TOKENS_CACHE))]
+
+            _TOKENS_CACHE[key] = Tokens.from_element(ET.fromstring(data, xml_parser(encoding="UTF-8")), version=version)
+
+        return _TOKENS_CACHE[key]
+
+    @staticmethod
+    def from_file(file: str | BinaryIO, version: OsVersion = OsVersions.LATEST) -> 'Tokens':
+        """
+        Constructs an instance from an XML file, parsing it directly
+
+        :param file: An XML file name or file opened in binary mode
+        :param version: A minimum OS version (defaults to latest)
+        :return: Token maps corresponding to the file
+        """
+
+        return Tokens.from_element(ET.parse(file, xml_parser()).getroot(), version=version)
 
     @staticmethod
-    def from_element(root: ET.Element, version: OsVersion = OsVersions.LATEST):
+    def clear_cache():
+        """
+        Clears the cache of instances constructed by from_xml_string
+        """
+
+        _TOKENS_CACHE.clear()
+
+    @staticmethod
+    def from_element(root: ET.Element, version: OsVersion = OsVersions.LATEST) -> 'Tokens':
         """
         Constructs an instance from an XML element in the token sheets
 
@@ -282,33 +384,40 @@ class Tokens:
         all_bytes: dict[bytes, Token] = {}
         all_langs: dict[str, dict[str, bytes]] = {}
 
-        def parse_page(element: ET.Element, bits: bytes = b""):
-            nonlocal all_bytes
-            nonlocal all_langs
+        all_langs_setdefault = all_langs.setdefault
+
+        # Walk the sheet in document order, carrying the bytes of each page
+        # Pages are never nested, so each token's bytes take a single concatenation
+        stack = [(root, b"")]
+
+        while stack:
+            element, bits = stack.pop()
 
             if element.tag == "token":
-                token_bits = bits + bytes.fromhex(element.attrib["value"][1:])
+                token_bits = bits + _decode_byte(element.attrib["value"])
                 token = Token.from_element(element, token_bits, version=version)
 
                 if token.langs:
                     all_bytes[token_bits] = token
                     for lang, translation in token.langs.items():
-                        if lang not in all_langs:
-                            all_langs[lang] = {}
+                        names = all_langs_setdefault(lang, {})
 
                         for name in translation.names():
-                            all_langs[lang][name] = token_bits
+                            names[name] = token_bits
 
-            for child in element:
-                if child.tag == "two-byte":
-                    parse_page(child, bits=bits + bytes.fromhex(child.attrib["value"][1:]))
-                else:
-                    parse_page(child, bits=bits)
+                # The rest of the token is read by Token.from_element
+                continue
 
-        parse_page(root)
+            stack.extend((child, bits + _decode_byte(child.attrib["value"]) if child.tag == "two-byte" else bits)
+                         for child in reversed(element))
 
         return Tokens(all_bytes, all_langs)
 
 
+# Instances constructed by Tokens.from_xml_string, keyed by string digest and version
+_TOKENS_CACHE: dict[tuple[bytes, OsVersion], Tokens] = {}
+_TOKENS_CACHE_SIZE = 8
+
+
 # with open("../8X.xml", encoding="UTF-8") as file:
 #   Tokens.from_xml_string(file.read())
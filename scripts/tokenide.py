@@ -1,6 +1,12 @@
+import functools
+import io
 import os
+import sys
 import xml.etree.ElementTree as ET
+from collections import Counter
+from typing import BinaryIO
 
+from .parse import ET as parse_ET, xml_iterparse
 from .parse import Tokens, OsVersion, OsVersions
 
 
@@ -12,26 +18,102 @@ TokenIDE created by
 Shaun McFall, Merthsoft Creations
 -->"""
 
+# TokenIDE byte strings, indexed by byte value
+_HEX = tuple(sys.intern(f"${byte:02X}") for byte in range(256))
+
+
+def _new_node(string: str = None, attrib: dict[str, str] = None) -> dict:
+    """
+    :param string: The token's string value, if any
+    :param attrib: The token's other attributes, if any
+    :return: A new token dictionary for a TokenIDESheet
+    """
+
+    return {"string": string, "variants": None, "attrib": {} if attrib is None else attrib}
+
+
+def _read_token(element: ET.Element, tokens: dict[bytes, dict], bits: bytes) -> bytes:
+    """
+    :param element: A <Token> element
+    :param tokens: The tokens of the sheet being read, to which the token is added
+    :param bits: The bytes of the token the element is nested in, if any
+    :return: The full bytes of the token
+    """
+
+    attrib = dict(element.attrib)
+    bits += bytes.fromhex(attrib.pop("byte").removeprefix("$"))
+
+    tokens[bits] = _new_node(attrib.pop("string", None), attrib)
+    return bits
+
+
+def _read_alt(element: ET.Element, tokens: dict[bytes, dict], bits: bytes):
+    """
+    :param element: An <Alt> element
+    :param tokens: The tokens of the sheet being read
+    :param bits: The bytes of the token the element is nested in, to which the variant is added
+    """
+
+    node = tokens[bits]
+    if (variants := node["variants"]) is None:
+        node["variants"] = variants = set()
+
+    variants.add(element.attrib["string"])
+
+
+def _read_meta(element: ET.Element) -> ET.Element:
+    """
+    :param element: A <Groups> or <Styles> element
+    :return: The element as an ElementTree element, since metadata is written back out with ElementTree
+    """
+
+    if not isinstance(element, ET.Element):
+        element = ET.fromstring(parse_ET.tostring(element))
+
+    return element
+
+
+@functools.lru_cache(maxsize=8)
+def _load_tokens(path: str, mtime: int, version: OsVersion) -> Tokens:
+    """
+    Parses a token sheet, caching the result by path, modification time, and version
+
+    :param path: The path to the token sheet
+    :param mtime: The modification time of the sheet, in nanoseconds
+    :param version: A minimum OS version
+    :return: Token maps corresponding to the sheet
+    """
+
+    with open(path, "rb") as file:
+        return Tokens.from_file(file, version)
+
 
 class TokenIDESheet:
     """
     Data class representing the contents of a TokenIDE token file
 
     The sheet is a dictionary with two elements:
-        - tokens:   a recursing dictionary of tokens, indexed by byte
+        - tokens:   a dictionary of tokens, indexed by their full bytes
         - meta:     global metadata for TokenIDE concerning styling and grouping
 
+    A token's set of variants is None until one is added.
+
     If an existing TokenIDE token file is not used a base, no metadata is present.
     """
 
     NAMESPACE = "http://merthsoft.com/Tokens"
+    PREFIX = f"{{{NAMESPACE}}}"
+
+    _ROOT_TAG = f"{PREFIX}Tokens"
+    _TOKEN_TAG, _ALT_TAG = f"{PREFIX}Token", f"{PREFIX}Alt"
+    _META_TAGS = f"{PREFIX}Groups", f"{PREFIX}Styles"
 
     STARTERS = [b'\x2A']
     TERMINATORS = [b'\x04', b'\x2A', b'\x3F']
 
     def __init__(self, sheet: dict[str] = None):
         self.sheet = sheet or {"tokens": {}, "meta": []}
-        self.sheet["tokens"] |= {"$00": {"string": "", "variants": set(), "attrib": {}, "tokens": {}}}
+        self.sheet["tokens"] |= {b"\x00": _new_node("")}
 
     @staticmethod
     def from_xml_string(xml_str: str) -> 'TokenIDESheet':
@@ -42,40 +124,87 @@ class TokenIDESheet:
         :return: A TokenIDESheet corresponding to the string
         """
 
-        return TokenIDESheet.from_element(ET.fromstring(xml_str))
+        return TokenIDESheet.from_file(io.BytesIO(xml_str.encode("UTF-8")))
+
+    @staticmethod
+    def from_file(file: BinaryIO) -> 'TokenIDESheet':
+        """
+        Constructs an instance from an XML file
+
+        The file is parsed incrementally, with lxml if it is installed.
+        Token elements are discarded once read, so the whole tree is never held in memory.
+
+        :param file: An XML file opened in binary mode
+        :return: A TokenIDESheet corresponding to the file
+        """
+
+        events = xml_iterparse(file, ("start", "end"))
+
+        _, root = next(events)
+        if root.tag != TokenIDESheet._ROOT_TAG:
+            raise ValueError("Not a TokenIDE xml.")
+
+        token_tag, alt_tag, meta_tags = TokenIDESheet._TOKEN_TAG, TokenIDESheet._ALT_TAG, TokenIDESheet._META_TAGS
+
+        sheet: dict[str] = {"tokens": {}, "meta": []}
+        tokens = sheet["tokens"]
+
+        # The bytes of each open token
+        stack = [b""]
+
+        for event, element in events:
+            tag = element.tag
+
+            if event == "start":
+                if tag == token_tag:
+                    stack.append(_read_token(element, tokens, stack[-1]))
+
+                elif tag == alt_tag:
+                    _read_alt(element, tokens, stack[-1])
+
+            elif tag == token_tag:
+                stack.pop()
+                element.clear()
+
+            elif tag in meta_tags:
+                sheet["meta"].append(_read_meta(element))
+
+        return TokenIDESheet(sheet)
 
     @staticmethod
     def from_element(root: ET.Element) -> 'TokenIDESheet':
         """
         Constructs an instance from an XML element in a TokenIDE token file
 
-        :param root: An XML element, which must be the root element of the file
+        :param root: An XML element from either ElementTree or lxml, which must be the root element of the file
         :return: A TokenIDESheet corresponding to the root element
         """
 
-        if root.tag != f"{{{TokenIDESheet.NAMESPACE}}}Tokens":
+        if root.tag != TokenIDESheet._ROOT_TAG:
             raise ValueError("Not a TokenIDE xml.")
 
+        token_tag, alt_tag, meta_tags = TokenIDESheet._TOKEN_TAG, TokenIDESheet._ALT_TAG, TokenIDESheet._META_TAGS
+
         sheet: dict[str] = {"tokens": {}, "meta": []}
+        tokens = sheet["tokens"]
+
+        # Walk the file in document order, carrying the bytes of the token each element belongs to
+        stack = [(root, b"")]
 
-        def parse_page(element: ET.Element, dct: dict):
-            match element.tag.removeprefix(f"{{{TokenIDESheet.NAMESPACE}}}"):
-                case "Token":
-                    attrib = element.attrib
+        while stack:
+            element, bits = stack.pop()
 
-                    dct["tokens"][attrib.pop("byte")] = dct = {"string": attrib.pop("string", None), "variants": set(),
-                                                               "attrib": attrib, "tokens": {}}
+            if (tag := element.tag) == token_tag:
+                bits = _read_token(element, tokens, bits)
 
-                case "Alt":
-                    dct["variants"].add(element.attrib["string"])
+            elif tag == alt_tag:
+                _read_alt(element, tokens, bits)
 
-                case "Groups" | "Styles":
-                    sheet["meta"].append(element)
+            elif tag in meta_tags:
+                sheet["meta"].append(_read_meta(element))
 
-            for child in element:
-                parse_page(child, dct)
+            stack.extend((child, bits) for child in reversed(element))
 
-        parse_page(root, sheet)
         return TokenIDESheet(sheet)
 
     def to_xml_string(self) -> str:
@@ -96,29 +225,37 @@ class TokenIDESheet:
         :return: This sheet as an XML element
         """
 
-        sheet = ET.Element(f"{{{TokenIDESheet.NAMESPACE}}}Tokens",
+        sheet = ET.Element(TokenIDESheet._ROOT_TAG,
                            {"xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
                             "xmlns:xsd": "http://www.w3.org/2001/XMLSchema"})
 
         sheet.extend(self.sheet["meta"] or [ET.Element("Groups"), ET.Element("Styles")])
 
-        def build_page(element: ET.Element, byte: str, dct: dict, depth: int = 0):
+        sub_element = ET.SubElement
+
+        # Elements for one-byte tokens, under which two-byte tokens are nested
+        pages = {}
+
+        # Sorting by bytes puts each token just after its leading byte
+        for bits, dct in sorted(self.sheet["tokens"].items()):
+            parent = pages[bits[:1]] if len(bits) > 1 else sheet
+            byte = _HEX[bits[-1]]
+
             # Special case for newline
-            if byte == "$3F" and depth == 1:
-                element = ET.SubElement(element, "Token", byte=byte, string=r"\n", stringTerminator="true")
+            if bits == b"\x3F":
+                element = sub_element(parent, "Token", byte=byte, string=r"\n", stringTerminator="true")
 
-            elif byte:
-                element = ET.SubElement(element, "Token", byte=byte,
-                                        **({"string": dct["string"]} if dct.get("string", None) is not None else {}),
-                                        **dct.get("attrib", {}))
+            else:
+                element = sub_element(parent, "Token", byte=byte,
+                                      **({"string": dct["string"]} if dct.get("string", None) is not None else {}),
+                                      **dct.get("attrib", {}))
 
-                for name in dct.get("variants", set()):
+                for name in dct.get("variants") or ():
                     element.append(ET.Element("Alt", string=name))
 
-            for child_byte, child_dct in sorted(dct.get("tokens", {}).items()):
-                build_page(element, child_byte, child_dct, depth + 1)
+            if len(bits) == 1:
+                pages[bits] = element
 
-        build_page(sheet, "", self.sheet)
         return sheet
 
     def for_version(self, *, version: OsVersion = None, lang: str = 'en') -> 'TokenIDESheet':
@@ -127,6 +264,7 @@ class TokenIDESheet:
 
         If a token is entirely absent, its accessible name is used as its string value.
         Metadata is always preserved.
+        The token sheets are parsed once per version and reused by later calls.
 
         :param version: The OS version to target (defaults to latest)
         :param lang: A language code (defaults to "en")
@@ -135,46 +273,47 @@ class TokenIDESheet:
 
         sheet = {"meta": self.sheet["meta"].copy(), "tokens": {}}
 
-        with open(os.path.join(os.path.dirname(__file__), "../8X.xml"), encoding="UTF-8") as file:
-            tokens = Tokens.from_xml_string(file.read(), version or OsVersions.LATEST)
+        # Language codes are interned when the token sheets are parsed
+        lang = sys.intern(lang)
+
+        path = os.path.join(os.path.dirname(__file__), "../8X.xml")
+        tokens = _load_tokens(path, os.stat(path).st_mtime_ns, version or OsVersions.LATEST)
 
         all_bytes = tokens.bytes
-        all_names = [name for token in all_bytes.values()
-                     for name in {*token.langs.get(lang, "en").names(), token.langs.get(lang, "en").display}]
+        name_counts = Counter(name for translation in (token.langs.get(lang, "en") for token in all_bytes.values())
+                              for name in {*translation.names(), translation.display})
+
+        new, base = sheet["tokens"], self.sheet["tokens"]
 
         for byte, token in all_bytes.items():
             if version is not None and token.since > version:
                 continue
 
-            leading, trailing = byte[:1], byte[1:]
-
-            new = sheet["tokens"]
-            attrib = self.sheet["tokens"].copy()
-            value = f"${leading.hex().upper()}"
+            # Two-byte tokens are nested under their leading byte
+            if len(byte) > 1 and byte[:1] not in new:
+                new[byte[:1]] = _new_node()
 
-            if value not in new:
-                new[value] = {"string": None, "variants": set(), "attrib": {}, "tokens": {}}
-
-            if trailing:
-                attrib = attrib[value]["tokens"]
-                new = new[value]["tokens"]
-                value = f"${trailing.hex().upper()}"
-
-                new[value] = {"string": None, "variants": set(), "attrib": {}, "tokens": {}}
+            if (node := new.get(byte)) is None:
+                new[byte] = node = _new_node()
 
             translation = token.langs.get(lang, "en")
             display = translation.display
 
-            new[value]["string"] = display if all_names.count(display) == 1 else translation.accessible
-            new[value]["variants"] |= {*translation.names()}
-            new[value]["variants"] -= {new[value]["string"]}
+            node["string"] = string = display if name_counts[display] == 1 else translation.accessible
+
+            if (variants := node["variants"]) is None:
+                node["variants"] = variants = set()
+
+            variants |= {*translation.names()}
+            variants.discard(string)
 
-            new[value]["attrib"] |= attrib.get(value, {}).get("attrib", {})
+            node_attrib = node["attrib"]
+            node_attrib.update(base.get(byte, {}).get("attrib", {}))
             if byte in TokenIDESheet.STARTERS:
-                new[value]["attrib"]["stringStarter"] = "true"
+                node_attrib["stringStarter"] = "true"
 
             if byte in TokenIDESheet.TERMINATORS:
-                new[value]["attrib"]["stringTerminator"] = "true"
+                node_attrib["stringTerminator"] = "true"
 
         return TokenIDESheet(sheet)
 
@@ -1,3 +1,5 @@
+from typing import Iterator
+
 from .parse import Token, Tokens
 
 
@@ -5,7 +7,9 @@ class TokenTrie:
     """
     Basic trie class for tokenizing text
     """
-    
+
+    __slots__ = ("token", "children")
+
     def __init__(self, token: Token = None):
         self.token = token
         self.children = {}
@@ -18,10 +22,10 @@ class TokenTrie:
         :param lang: The language to insert names from
         """
         
-        if lang not in token.langs:
+        if (translation := token.langs.get(lang)) is None:
             raise ValueError(f"lang {lang} not found")
 
-        for name in token.langs[lang].names():
+        for name in translation.names():
             current = self
             for char in name:
                 if char not in current.children:
@@ -60,13 +64,19 @@ class TokenTrie:
         """
         
         tokens = []
+        current, index = self, 0
 
-        if string and string[0] in self.children:
-            tokens += self.children[string[0]].get_tokens(string[1:])
+        # Walk down the trie one character at a time, noting each token passed
+        while True:
+            if current.token:
+                tokens.append((current.token, string[index:]))
 
-        if self.token:
-            tokens.append((self.token, string))
+            if index >= len(string) or (current := current.children.get(string[index])) is None:
+                break
 
+            index += 1
+
+        tokens.reverse()
         return tokens
 
     def get_longest_token(self, string: str) -> tuple[Token, str]:
@@ -76,4 +86,49 @@ class TokenTrie:
         :return: A tuple of a token and the remaining input after parsing
         """
         
-        return self.get_tokens(string)[0]
+        longest = None
+        current, index = self, 0
+
+        while True:
+            if current.token:
+                longest = current.token, index
+
+            if index >= len(string) or (current := current.children.get(string[index])) is None:
+                break
+
+            index += 1
+
+        if longest is None:
+            raise IndexError(f"no token found at the start of {string!r}")
+
+        token, index = longest
+        return token, string[index:]
+
+    def tokenize_stream(self, string: str) -> Iterator[tuple[Token, int]]:
+        """
+        Tokenizes an entire input string, always taking the longest token available
+
+        Each token is yielded with the index of the input string at which its name ends.
+        Unlike repeated calls to get_longest_token, the remaining input is never copied.
+
+        :param string: The input string
+        :return: An iterator of tuples each containing a token and the end of its name in the input
+        """
+
+        start = 0
+
+        while start < len(string):
+            longest = None
+            current, index = self, start
+
+            while index < len(string) and (current := current.children.get(string[index])) is not None:
+                index += 1
+
+                if current.token:
+                    longest = current.token, index
+
+            if longest is None:
+                raise ValueError(f"no token found at index {start} of {string!r}")
+
+            yield longest
+            start = longest[1]